@@ -4,14 +4,26 @@
 
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+import sys
+from functools import lru_cache
+from concurrent.futures import wait
+from typing import TYPE_CHECKING, TypeVar
 from dataclasses import dataclass
 
 import _ba
+from ba._error import print_exception
 
 if TYPE_CHECKING:
+    from typing import Any
+    from concurrent.futures import Future
+
     import ba
 
+T = TypeVar('T')
+
+# Lazily-loaded sound we play on plugin errors.
+_error_sound_cached: ba.Sound | None = None
+
 
 class PluginSubsystem:
     """Subsystem for plugin handling in the app.
@@ -25,47 +37,77 @@ class PluginSubsystem:
         self.potential_plugins: list[ba.PotentialPlugin] = []
         self.active_plugins: dict[str, ba.Plugin] = {}
 
+        # Active plugins per hook name; only includes plugins that
+        # subscribe to a hook *and* actually override it, so dispatch
+        # skips the no-op base-class calls.
+        self._hook_plugins: dict[str, list[ba.Plugin]] = {}
+
+        # Plugin classes that have been loaded but not yet instantiated;
+        # we wait until the first lifecycle hook they subscribe to.
+        self.pending_plugins: dict[str, type[ba.Plugin]] = {}
+
     def on_app_running(self) -> None:
         """Should be called when the app reaches the running state."""
         # Load up our plugins and go ahead and call their on_app_running calls.
         self.load_plugins()
-        for plugin in self.active_plugins.values():
-            try:
-                plugin.on_app_running()
-            except Exception:
-                from ba import _error
-                _error.print_exception('Error in plugin on_app_running()')
+        self._dispatch_hook('on_app_running')
 
     def on_app_pause(self) -> None:
         """Called when the app goes to a suspended state."""
-        for plugin in self.active_plugins.values():
-            try:
-                plugin.on_app_pause()
-            except Exception:
-                from ba import _error
-                _error.print_exception('Error in plugin on_app_pause()')
+        self._dispatch_hook('on_app_pause')
 
     def on_app_resume(self) -> None:
         """Run when the app resumes from a suspended state."""
-        for plugin in self.active_plugins.values():
-            try:
-                plugin.on_app_resume()
-            except Exception:
-                from ba import _error
-                _error.print_exception('Error in plugin on_app_resume()')
+        self._dispatch_hook('on_app_resume')
 
     def on_app_shutdown(self) -> None:
         """Called when the app is being closed."""
-        for plugin in self.active_plugins.values():
-            try:
-                plugin.on_app_shutdown()
-            except Exception:
-                from ba import _error
-                _error.print_exception('Error in plugin on_app_shutdown()')
+        self._dispatch_hook('on_app_shutdown')
+
+    def _dispatch_hook(self, hook: str) -> None:
+        """Call a lifecycle hook on all plugins subscribing to it.
+
+        Pending plugins subscribing to the hook are instantiated first.
+        Plugins declaring themselves PARALLEL_SAFE are run in the app
+        thread-pool alongside the others; we still wait for all of them
+        to finish before returning.
+        """
+        for plugkey, cls in list(self.pending_plugins.items()):
+            if hook in cls.HOOKS:
+                del self.pending_plugins[plugkey]
+                self._instantiate_plugin(plugkey, cls)
+
+        futures: list[Future] = []
+        for plugin in self._hook_plugins.get(hook, []):
+            if plugin.PARALLEL_SAFE:
+                futures.append(
+                    _ba.app.threadpool.submit(_call_plugin_hook, plugin, hook))
+            else:
+                _call_plugin_hook(plugin, hook)
+        if futures:
+            wait(futures)
+
+    def _instantiate_plugin(self, plugkey: str, cls: type[ba.Plugin]) -> None:
+        from ba._language import Lstr
+        try:
+            plugin = cls()
+            assert plugkey not in self.active_plugins
+            self.active_plugins[plugkey] = plugin
+            for hook in cls.HOOKS:
+                call = getattr(cls, hook, None)
+                basecall = getattr(Plugin, hook, None)
+                if call is not None and call is not basecall:
+                    self._hook_plugins.setdefault(hook, []).append(plugin)
+        except Exception as exc:
+            _play_error_sound()
+            _ba.screenmessage(Lstr(resource='pluginInitErrorText',
+                                   subs=[('${PLUGIN}', plugkey),
+                                         ('${ERROR}', str(exc))]),
+                              color=(1, 0, 0))
+            print_exception(f"Error initing plugin: '{plugkey}'.")
 
     def load_plugins(self) -> None:
         """(internal)"""
-        from ba._general import getclass
         from ba._language import Lstr
 
         # Note: the plugins we load is purely based on what's enabled
@@ -73,19 +115,32 @@ class PluginSubsystem:
         # plugins, but that is only used to give the user a list of plugins
         # that they can enable. (we wouldn't want to look at meta-scan here
         # anyway because it may not be done yet at this point in the launch)
-        plugstates: dict[str, dict] = _ba.app.config.get('Plugins', {})
-        assert isinstance(plugstates, dict)
-        plugkeys: list[str] = sorted(key for key, val in plugstates.items()
-                                     if val.get('enabled', False))
+        # Also note that we only load plugin classes here; instantiation
+        # is deferred until the first hook each plugin subscribes to.
+        cfg = _ba.app.config
+        plugstates: dict[str, dict] = cfg.get('Plugins', {})
+        # (Keep these sorted; it gives us a deterministic load order and
+        # our resolve cache relies on a stable list).
+        plugkeys: list[str] = sorted(
+            [key for key, val in plugstates.items() if val.get('enabled')])
         disappeared_plugs: set[str] = set()
+
+        # If the set of enabled plugins (and the paths they'd be imported
+        # from) is unchanged since last launch we may be able to load
+        # their modules straight from known files.
+        cached_entries = _read_plugin_resolve_cache(plugkeys)
+        new_entries: dict[str, dict[str, Any]] = {}
         for plugkey in plugkeys:
             try:
-                cls = getclass(plugkey, Plugin)
+                entry = cached_entries.get(plugkey)
+                if entry is not None:
+                    _preload_plugin_module(plugkey, entry)
+                cls = _resolve_plugin_class(plugkey)
             except ModuleNotFoundError:
                 disappeared_plugs.add(plugkey)
                 continue
             except Exception as exc:
-                _ba.playsound(_ba.getsound('error'))
+                _play_error_sound()
                 _ba.screenmessage(Lstr(resource='pluginClassLoadErrorText',
                                        subs=[('${PLUGIN}', plugkey),
                                              ('${ERROR}', str(exc))]),
@@ -93,18 +148,18 @@ class PluginSubsystem:
                 _ba.log(f"Error loading plugin class '{plugkey}': {exc}",
                         to_server=False)
                 continue
-            try:
-                plugin = cls()
-                assert plugkey not in self.active_plugins
-                self.active_plugins[plugkey] = plugin
-            except Exception as exc:
-                from ba import _error
-                _ba.playsound(_ba.getsound('error'))
-                _ba.screenmessage(Lstr(resource='pluginInitErrorText',
-                                       subs=[('${PLUGIN}', plugkey),
-                                             ('${ERROR}', str(exc))]),
-                                  color=(1, 0, 0))
-                _error.print_exception(f"Error initing plugin: '{plugkey}'.")
+            assert plugkey not in self.pending_plugins
+            self.pending_plugins[plugkey] = cls
+            entry = _plugin_module_entry(plugkey)
+            if entry is not None:
+                new_entries[plugkey] = entry
+
+        # (Disappeared plugins get pruned from the config below, so leave
+        # them out here so the cache matches next time).
+        if new_entries != cached_entries:
+            _write_plugin_resolve_cache(
+                [p for p in plugkeys if p not in disappeared_plugs],
+                new_entries)
 
         # If plugins disappeared, let the user know gently and remove them
         # from the config so we'll again let the user know if they later
@@ -122,9 +177,163 @@ class PluginSubsystem:
                 f'{len(disappeared_plugs)} plugin(s) no longer found:'
                 f' {plugnames}.',
                 to_server=False)
-            for goneplug in disappeared_plugs:
-                del _ba.app.config['Plugins'][goneplug]
-            _ba.app.config.commit()
+            # Swap in a pruned copy in one go and commit just once.
+            plug_cfg = cfg['Plugins']
+            plug_cfg_new = {
+                key: val
+                for key, val in plug_cfg.items()
+                if key not in disappeared_plugs
+            }
+            if plug_cfg_new != plug_cfg:
+                cfg['Plugins'] = plug_cfg_new
+                cfg.commit()
+
+
+def _play_error_sound() -> None:
+    # pylint: disable=global-statement
+    global _error_sound_cached
+    # We load and play this in the ui context so it isn't tied to (and
+    # can be played regardless of) whatever activity might be current.
+    with _ba.Context('ui'):
+        if _error_sound_cached is None:
+            _error_sound_cached = _ba.getsound('error')
+        _ba.playsound(_error_sound_cached)
+
+
+def _call_plugin_hook(plugin: ba.Plugin, hook: str) -> None:
+    try:
+        getattr(plugin, hook)()
+    except Exception:
+        print_exception(f'Error in plugin {hook}()')
+
+
+@lru_cache(maxsize=None)
+def _resolve_plugin_class(plugkey: str) -> type[Plugin]:
+    """Return the plugin class for a key, caching successful lookups.
+
+    Failed lookups raise and are not cached, so plugins that disappear
+    (or fail to import) are re-checked on each call.
+    """
+    return _cached_getclass(plugkey, Plugin)
+
+
+def _cached_getclass(name: str, subclassof: type[T]) -> type[T]:
+    """Like ba.getclass() but skips the import machinery when possible.
+
+    If the class's module is already present in sys.modules we pull the
+    class from it directly instead of going through importlib (which
+    grabs the import lock and walks finders even for loaded modules).
+    """
+    modulename, _, classname = name.rpartition('.')
+    module = sys.modules.get(modulename)
+    if module is None:
+        import importlib
+        module = importlib.import_module(modulename)
+    cls: type = getattr(module, classname)
+
+    if not issubclass(cls, subclassof):
+        raise TypeError(f'{name} is not a subclass of {subclassof}.')
+    return cls
+
+
+def _plugin_resolve_cache_path() -> str:
+    import os
+    return os.path.join(_ba.get_volatile_data_directory(),
+                        'plugin_resolve_cache.json')
+
+
+def _read_plugin_resolve_cache(plugkeys: list[str]) -> dict[str, Any]:
+    """Return cached module entries if they apply to this set of plugins.
+
+    Entries are only valid for the sys.path they were recorded with;
+    otherwise (switching workspaces, etc.) a regular import could resolve
+    a module to a different file than the one we have cached.
+    """
+    import json
+    try:
+        with open(_plugin_resolve_cache_path(), encoding='utf-8') as infile:
+            data = json.loads(infile.read())
+    except Exception:
+        # Missing or corrupt; we'll just rebuild it.
+        return {}
+    if (not isinstance(data, dict) or data.get('plugkeys') != plugkeys
+            or data.get('sys_path') != sys.path):
+        return {}
+    entries = data.get('entries')
+    return entries if isinstance(entries, dict) else {}
+
+
+def _write_plugin_resolve_cache(plugkeys: list[str],
+                                entries: dict[str, Any]) -> None:
+    import os
+    import json
+    path = _plugin_resolve_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as outfile:
+            outfile.write(
+                json.dumps({
+                    'plugkeys': plugkeys,
+                    'sys_path': sys.path,
+                    'entries': entries
+                }))
+    except Exception:
+        print_exception('Error writing plugin resolve cache.')
+
+
+def _plugin_module_entry(plugkey: str) -> dict[str, Any] | None:
+    """Return a cache entry for a plugin key's module (if possible).
+
+    Note that this is the module the key names, which is not necessarily
+    the one the class was defined in (it may be re-exported).
+    We only handle top-level modules; submodules need their parent
+    packages imported first so we leave those to the regular import path.
+    """
+    import os
+    modulename = plugkey.rpartition('.')[0]
+    if '.' in modulename:
+        return None
+    module = sys.modules.get(modulename)
+    path = getattr(module, '__file__', None)
+    if not isinstance(path, str):
+        return None
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    return {'file': path, 'mtime_ns': mtime_ns}
+
+
+def _preload_plugin_module(plugkey: str, entry: dict[str, Any]) -> None:
+    """Load a plugin's module directly from its cached file location.
+
+    This skips the finder walk that a regular import would do. If the
+    file seems to have changed we do nothing and the regular import path
+    is used instead.
+    """
+    import os
+    import importlib.util
+    modulename = plugkey.rpartition('.')[0]
+    if modulename in sys.modules or '.' in modulename:
+        return
+    path = entry.get('file')
+    if not isinstance(path, str):
+        return
+    try:
+        if os.stat(path).st_mtime_ns != entry.get('mtime_ns'):
+            return
+    except OSError:
+        return
+    spec = importlib.util.spec_from_file_location(modulename, path)
+    if spec is None or spec.loader is None:
+        return
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[modulename] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[modulename]
+        raise
 
 
 @dataclass
@@ -154,6 +363,17 @@ class Plugin:
     app is running in order to modify its behavior in some way.
     """
 
+    # The lifecycle hooks this plugin wants to be called for. Plugins
+    # are not instantiated until the first of these fires, so plugins
+    # only needing some of them can override this to cut startup work.
+    HOOKS: frozenset[str] = frozenset(
+        {'on_app_running', 'on_app_pause', 'on_app_resume', 'on_app_shutdown'})
+
+    # Plugins can set this to True if their hooks are safe to run in a
+    # background thread (no ba/_ba calls, etc.). Such plugins get run in
+    # parallel with each other, which helps if they do blocking i/o.
+    PARALLEL_SAFE: bool = False
+
     def on_app_running(self) -> None:
         """Called when the app reaches the running state."""
 
@@ -97,11 +97,13 @@ class PluginSettingsWindow(ba.Window):
             ba.screenmessage('Still scanning plugins; please try again.',
                              color=(1, 0, 0))
             ba.playsound(ba.getsound('error'))
-        pluglist = ba.app.plugins.potential_plugins
+        plugs = ba.app.plugins
+        pluglist = plugs.potential_plugins
         plugstates: dict[str, dict] = ba.app.config.setdefault('Plugins', {})
         assert isinstance(plugstates, dict)
         for i, availplug in enumerate(pluglist):
-            active = availplug.class_path in ba.app.plugins.active_plugins
+            active = (availplug.class_path in plugs.active_plugins
+                      or availplug.class_path in plugs.pending_plugins)
 
             plugstate = plugstates.setdefault(availplug.class_path, {})
             checked = plugstate.get('enabled', False)
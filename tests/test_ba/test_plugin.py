@@ -0,0 +1,69 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing plugin functionality."""
+
+from __future__ import annotations
+
+import sys
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+
+import _ba
+# noinspection PyProtectedMember
+from ba import _plugin
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import pytest
+
+
+class _Config(dict):
+
+    def commit(self) -> None:
+        """Pretend to write the config."""
+
+
+def test_plugin_resolve_cache_reexport(
+        tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Plugins re-exported from other modules should survive the cache."""
+    # pylint: disable=protected-access
+
+    plugdir = tmp_path / 'plugins'
+    plugdir.mkdir()
+    (plugdir / 'realmod.py').write_text('import ba\n'
+                                        'class RealPlugin(ba.Plugin):\n'
+                                        '    """A plugin."""\n')
+    (plugdir / 'reexport.py'
+     ).write_text('from realmod import RealPlugin as Reexported\n')
+    monkeypatch.syspath_prepend(str(plugdir))
+
+    config = _Config(Plugins={'reexport.Reexported': {'enabled': True}})
+    monkeypatch.setattr(_ba,
+                        'app',
+                        SimpleNamespace(config=config),
+                        raising=False)
+    monkeypatch.setattr(_ba, 'get_volatile_data_directory',
+                        lambda: str(tmp_path / 'volatile'))
+    errors: list[str] = []
+    monkeypatch.setattr(_plugin, '_play_error_sound',
+                        lambda: errors.append('error'))
+    monkeypatch.setattr(_ba, 'screenmessage', lambda *args, **kwargs: None)
+    monkeypatch.setattr(_ba, 'log', lambda *args, **kwargs: None)
+
+    # Simulate a few launches; the first writes the resolve cache and
+    # later ones load from it.
+    for _launch in range(3):
+        for modname in ('reexport', 'realmod'):
+            monkeypatch.delitem(sys.modules, modname, raising=False)
+        _plugin._resolve_plugin_class.cache_clear()
+
+        plugins = _plugin.PluginSubsystem()
+        plugins.load_plugins()
+        assert not errors
+        cls = plugins.pending_plugins['reexport.Reexported']
+        assert cls.__name__ == 'RealPlugin'
+        assert 'reexport.Reexported' in config['Plugins']
+
+    assert (tmp_path / 'volatile' / 'plugin_resolve_cache.json').exists()
+    _plugin._resolve_plugin_class.cache_clear()
@@ -8,7 +8,9 @@ import time
 import random
 import asyncio
 import weakref
+import itertools
 from enum import unique, Enum
+from unittest import mock
 from typing import TYPE_CHECKING
 from dataclasses import dataclass
 
@@ -406,3 +408,91 @@ def test_client_interrupt() -> None:
             await tester.server.send_message(_Message(_MessageType.TEST_SLOW))
 
     tester.run(_do_it())
+
+
+def test_many_messages() -> None:
+    """Test sending more messages than can be in flight at once."""
+    tester = _Tester()
+
+    async def _do_it() -> None:
+
+        # Answered messages should not count against the in-flight limit.
+        with mock.patch.object(tester.server.endpoint,
+                               'MAX_IN_FLIGHT_MESSAGES', 3):
+            for _i in range(12):
+                resp = await tester.server.send_message(
+                    _Message(_MessageType.TEST1))
+                assert resp.messagetype is _MessageType.RESPONSE1
+
+        # pylint: disable=protected-access
+        # noinspection PyProtectedMember
+        assert not tester.server.endpoint._in_flight_messages
+
+    tester.run(_do_it())
+
+
+def test_in_flight_limit() -> None:
+    """Test sends failing when too many messages are in flight."""
+    tester = _Tester()
+
+    async def _do_it() -> None:
+        with mock.patch.object(tester.server.endpoint,
+                               'MAX_IN_FLIGHT_MESSAGES', 3):
+            # Fill up our in-flight slots with slow messages.
+            slow_msg = _Message(_MessageType.TEST_SLOW)
+            slow_sends = [
+                asyncio.create_task(tester.server.send_message(slow_msg))
+                for _i in range(3)
+            ]
+            await asyncio.sleep(0.1)
+
+            # While those are still waiting, further sends should fail.
+            with pytest.raises(CommunicationError):
+                await tester.server.send_message(_Message(_MessageType.TEST1))
+
+            results = await asyncio.gather(*slow_sends)
+            assert all(r.messagetype is _MessageType.RESPONSE_SLOW
+                       for r in results)
+
+            # ...and once those are answered we should be able to send again.
+            resp = await tester.server.send_message(
+                _Message(_MessageType.TEST1))
+            assert resp.messagetype is _MessageType.RESPONSE1
+
+    tester.run(_do_it())
+
+
+def test_message_id_wraparound() -> None:
+    """Test that message ids still in flight get skipped."""
+    tester = _Tester()
+
+    async def _do_it() -> None:
+        # pylint: disable=protected-access
+        endpoint = tester.server.endpoint
+
+        slow_send = asyncio.create_task(
+            tester.server.send_message(_Message(_MessageType.TEST_SLOW)))
+        await asyncio.sleep(0.1)
+
+        # noinspection PyProtectedMember
+        slow_ids = list(endpoint._in_flight_messages)
+        assert len(slow_ids) == 1
+
+        # Rewind our id counter so the next send lands on the slow
+        # message's id; it should move on to the next one instead.
+        # noinspection PyProtectedMember
+        endpoint._message_ids = itertools.count(slow_ids[0])
+        fast_send = asyncio.create_task(
+            tester.server.send_message(_Message(_MessageType.TEST1)))
+        await asyncio.sleep(0)
+        # noinspection PyProtectedMember
+        assert set(endpoint._in_flight_messages) == {
+            slow_ids[0], (slow_ids[0] + 1) & 0xFFFF
+        }
+
+        resp = await fast_send
+        assert resp.messagetype is _MessageType.RESPONSE1
+        resp = await slow_send
+        assert resp.messagetype is _MessageType.RESPONSE_SLOW
+
+    tester.run(_do_it())
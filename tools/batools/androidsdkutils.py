@@ -4,23 +4,29 @@
 from __future__ import annotations
 
 import os
+import re
 import sys
+import json
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 from efro.error import CleanError
 
 if TYPE_CHECKING:
-    pass
+    from typing import Any
+
+# (Note: no \s here since that would let us match across lines).
+_SDK_DIR_RE = re.compile(
+    rb'(?m)^[ \t]*sdk\.dir[ \t]*=[ \t]*([^\r\n]+?)[ \t\r]*$')
 
 
 def _parse_lprop_file(local_properties_path: str) -> str:
-    with open(local_properties_path, encoding='utf-8') as infile:
-        lines = infile.read().splitlines()
-    sdk_dir_lines = [l for l in lines if 'sdk.dir=' in l]
-    if len(sdk_dir_lines) != 1:
+    with open(local_properties_path, 'rb') as infile:
+        data = infile.read()
+    sdk_dir_matches: list[bytes] = _SDK_DIR_RE.findall(data)
+    if len(sdk_dir_matches) != 1:
         raise Exception("Couldn't find sdk dir in local.properties")
-    sdk_dir = sdk_dir_lines[0].split('=')[1].strip()
+    sdk_dir = sdk_dir_matches[0].decode('utf-8')
     if not os.path.isdir(sdk_dir):
         raise Exception(f'Sdk dir from local.properties not found: {sdk_dir}.')
     return sdk_dir
@@ -46,22 +52,23 @@ def _gen_lprop_file(local_properties_path: str) -> str:
     # Otherwise try some standard locations.
     if not found:
         home = os.getenv('HOME')
-        assert home is not None
+        if home is None:
+            raise CleanError(
+                'HOME env var not set; cannot locate Android sdk.')
         test_paths = [home + '/Library/Android/sdk']
         for sdk_dir in test_paths:
             if os.path.exists(sdk_dir):
                 found = True
                 break
+    # (If we didn't find anything we already know sdk_dir doesn't exist;
+    # no need to stat it again).
     if not found:
-        print('WOULD CHECK', os.environ.get('ANDROID_SDK_ROOT'))
+        print(
+            'ERROR: Android sdk not found (ANDROID_SDK_ROOT is'
+            f' {envvar!r}); install the android sdk and try again',
+            file=sys.stderr)
+        sys.exit(255)
     assert sdk_dir is not None
-    if not found:
-        if not os.path.exists(sdk_dir):
-            print(
-                'ERROR: Android sdk not found; install '
-                'the android sdk and try again',
-                file=sys.stderr)
-            sys.exit(255)
     config = ('\n# This file was automatically generated by ' +
               os.path.abspath(sys.argv[0]) + '\n'
               '# Feel free to override these paths if you have your android'
@@ -78,8 +85,6 @@ def _gen_lprop_file(local_properties_path: str) -> str:
 
 def run(projroot: str, args: list[str]) -> None:
     """Main script entry point."""
-    # pylint: disable=too-many-branches
-    # pylint: disable=too-many-locals
 
     if len(args) != 1:
         raise CleanError('Expected 1 arg')
@@ -91,33 +96,108 @@ def run(projroot: str, args: list[str]) -> None:
         print('INVALID ARG; expected one of', valid_args, file=sys.stderr)
         sys.exit(255)
 
+    # The get-* commands get invoked a lot during builds, so we cache
+    # their results until something they depend on changes.
+    if command == 'check':
+        _run_command(projroot, command)
+        return
+
+    cachepath = Path(projroot, '.cache', 'android_sdk_utils')
+    cache: dict[str, Any] = {}
+    if cachepath.exists():
+        try:
+            with cachepath.open(encoding='utf-8') as infile:
+                cache = json.loads(infile.read())
+        except Exception:
+            cache = {}
+    if (not isinstance(cache, dict)
+            or not isinstance(cache.get('outputs'), dict)
+            or cache.get('key') != _get_cache_key(projroot)):
+        cache = {'outputs': {}}
+
+    # All of our outputs are paths; if the one we have cached has since
+    # gone away, rerun so we fail with a proper error message.
+    output = cache['outputs'].get(command)
+    if output is not None and not _cached_output_exists(output):
+        output = None
+    if output is None:
+        output = _run_command(projroot, command)
+        assert output is not None
+
+        # Note: we calc our key *after* running the command since it
+        # may have generated our local.properties file.
+        cache['key'] = _get_cache_key(projroot)
+        cache['outputs'][command] = output
+        cachepath.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = cachepath.with_suffix('.tmp' + str(os.getpid()))
+        with tmppath.open('w', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(cache))
+        os.replace(tmppath, cachepath)
+    print(output)
+
+
+def _cached_output_exists(output: str) -> bool:
+    # (get-adb-path gives us a plain 'adb' if that is what's in PATH).
+    if output == 'adb':
+        import shutil
+        return shutil.which(output) is not None
+    return os.path.exists(output)
+
+
+def _get_cache_key(projroot: str) -> list:
+    """Return values which should invalidate cached results on change."""
+    key: list = []
+    for fname in ['local.properties', 'build.gradle']:
+        try:
+            key.append(
+                os.stat(os.path.join(projroot, 'ballisticacore-android',
+                                     fname)).st_mtime_ns)
+        except FileNotFoundError:
+            key.append(0)
+    # (PATH affects whether get-adb-path gives us a plain 'adb').
+    for envvar in ['ANDROID_HOME', 'ANDROID_SDK_ROOT', 'PATH']:
+        key.append(os.environ.get(envvar, ''))
+    return key
+
+
+def _run_command(projroot: str, command: str) -> str | None:
+    """Run a command, returning its output (if any)."""
+    # pylint: disable=too-many-branches
+
     # In all cases we make sure there's a local.properties in our android
     # dir that contains valid sdk path.  If not, we attempt to create it.
     local_properties_path = os.path.join(projroot, 'ballisticacore-android',
                                          'local.properties')
-    if os.path.isfile(local_properties_path):
+    # (Just try to read it instead of stat-ing it first).
+    try:
         sdk_dir = _parse_lprop_file(local_properties_path)
-    else:
+    except FileNotFoundError:
         sdk_dir = _gen_lprop_file(local_properties_path)
 
+    # Note: we only run the sanity checks each command actually needs;
+    # these get invoked a lot during builds so it's nice to keep them lean.
+
     # Sanity check; look for a few things in the sdk that we expect to
-    # be there.
-    if not os.path.isfile(sdk_dir + '/platform-tools/adb'):
-        raise Exception('ERROR: android sdk at "' + sdk_dir +
-                        '" does not seem valid')
+    # be there. (get-adb-path does its own more specific check below).
+    if command == 'check':
+        if not os.path.isfile(sdk_dir + '/platform-tools/adb'):
+            raise Exception('ERROR: android sdk at "' + sdk_dir +
+                            '" does not seem valid')
 
     # Sanity check: if they've got ANDROID_HOME set, make sure it lines up with
     # what we're pointing at.
-    android_home = os.getenv('ANDROID_HOME')
-    if android_home is not None:
-        if android_home != sdk_dir:
-            print('ERROR: sdk dir mismatch; ANDROID_HOME is "' + android_home +
-                  '" but local.properties set to "' + sdk_dir + '"',
-                  file=sys.stderr)
-            sys.exit(255)
+    if command in {'check', 'get-sdk-path'}:
+        android_home = os.getenv('ANDROID_HOME')
+        if android_home is not None:
+            if android_home != sdk_dir:
+                print('ERROR: sdk dir mismatch; ANDROID_HOME is "' +
+                      android_home + '" but local.properties set to "' +
+                      sdk_dir + '"',
+                      file=sys.stderr)
+                sys.exit(255)
 
     if command == 'get-sdk-path':
-        print(sdk_dir)
+        return sdk_dir
 
     # We no longer add the ndk path to local.properties (doing so is obsolete)
     # but we still want to support returning the ndk path, as some things such
@@ -125,23 +205,26 @@ def run(projroot: str, args: list[str]) -> None:
     # the project gradle file where we set it explicitly.
     if command == 'get-ndk-path':
         gradlepath = Path(projroot, 'ballisticacore-android/build.gradle')
+        ver: str | None = None
         with gradlepath.open(encoding='utf-8') as infile:
-            lines = [
-                l for l in infile.readlines()
-                if l.strip().startswith('ext.ndk_version = ')
-            ]
-        if len(lines) != 1:
-            raise RuntimeError(
-                f'Expected exactly one ndk_version line in build.gradle;'
-                f' found {len(lines)}')
-        ver = lines[0].strip().replace("'", '').replace('"', '').split()[-1]
+            for line in infile:
+                line = line.strip()
+                if not line.startswith('ext.ndk_version = '):
+                    continue
+                if ver is not None:
+                    raise RuntimeError('Expected exactly one ndk_version line'
+                                       ' in build.gradle; found multiple')
+                ver = line.replace("'", '').replace('"', '').split()[-1]
+        if ver is None:
+            raise RuntimeError('Expected exactly one ndk_version line'
+                               ' in build.gradle; found 0')
         path = os.path.join(sdk_dir, 'ndk', ver)
         if not os.path.isdir(path):
             raise Exception(f'NDK listed in gradle not found: {path}')
-        print(path)
+        return path
 
     if command == 'get-adb-path':
-        import subprocess
+        import shutil
         adbpath = Path(sdk_dir, 'platform-tools/adb')
         if not os.path.exists(adbpath):
             raise Exception(f'ADB not found at expected path {adbpath}')
@@ -150,13 +233,10 @@ def run(projroot: str, args: list[str]) -> None:
         # Now, for extra credit, let's see if 'which adb' points to the
         # same one and simply return 'adb' if so. This makes our make
         # output nice and readable (and hopefully won't cause problems)
-        result = subprocess.run('which adb',
-                                shell=True,
-                                capture_output=True,
-                                check=False)
-        if result.returncode == 0:
-            wpath = result.stdout.decode().strip()
-            if wpath == str(adbpath):
-                print('adb')
-                return
-        print(adbpath)
+        wpath = shutil.which('adb')
+        if wpath is not None and (os.path.realpath(wpath)
+                                  == os.path.realpath(adbpath)):
+            return 'adb'
+        return str(adbpath)
+
+    return None
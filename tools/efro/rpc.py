@@ -4,16 +4,18 @@
 
 from __future__ import annotations
 
+import sys
 import time
+import struct
 import asyncio
 import logging
 import weakref
+import itertools
 from enum import Enum
 from dataclasses import dataclass
 from threading import current_thread
 from typing import TYPE_CHECKING, Annotated
 
-from efro.util import assert_never
 from efro.error import (CommunicationError,
                         is_asyncio_streams_communication_error)
 from efro.dataclassio import (dataclass_to_json, dataclass_from_json,
@@ -40,6 +42,25 @@ class _PacketType(Enum):
 
 _BYTE_ORDER: Literal['big'] = 'big'
 
+# Prebuilt packet headers; type (1b), message_id (2b), and len (2b or 4b).
+_HEADER = struct.Struct('>BHH')
+_HEADER_BIG = struct.Struct('>BHI')
+
+# Keepalive packets consist of just the type byte; no need to rebuild it.
+_KEEPALIVE_PACKET = _PacketType.KEEPALIVE.value.to_bytes(1, _BYTE_ORDER)
+
+# Incoming message/response headers (after the type byte has been read);
+# message_id (2b) and len (2b or 4b).
+_SUBHEADER = struct.Struct('>HH')
+_SUBHEADER_BIG = struct.Struct('>HI')
+
+# Length prefix for our handshake.
+# Note that the handshake itself needs to stay length-prefixed json; it
+# goes out before we know what protocol our peer speaks, so its format
+# can't be changed without breaking older peers. It's only sent once per
+# connection anyway (and we build ours just once; see _get_handshake()).
+_HANDSHAKE_LEN = struct.Struct('>I')
+
 
 @ioprepped
 @dataclass
@@ -65,20 +86,14 @@ class _InFlightMessage:
     """Represents a message that is out on the wire."""
 
     def __init__(self) -> None:
-        self._response: bytes | None = None
-        self._got_response = asyncio.Event()
-        self.wait_task = asyncio.create_task(self._wait())
-
-    async def _wait(self) -> bytes:
-        await self._got_response.wait()
-        assert self._response is not None
-        return self._response
+        self.future: asyncio.Future[bytes] = (
+            asyncio.get_running_loop().create_future())
 
     def set_response(self, data: bytes) -> None:
         """Set response data."""
-        assert self._response is None
-        self._response = data
-        self._got_response.set()
+        # (We may have stopped waiting due to cancellation or whatnot).
+        if not self.future.done():
+            self.future.set_result(data)
 
 
 class _KeepaliveTimeoutError(Exception):
@@ -109,6 +124,15 @@ class RPCEndpoint:
     # disconnect.
     DEFAULT_KEEPALIVE_TIMEOUT = 30.0
 
+    # How many of our messages can be awaiting responses at once. Sends
+    # beyond this fail immediately. (This also keeps us well clear of
+    # running out of 16 bit message ids).
+    MAX_IN_FLIGHT_MESSAGES = 4096
+
+    # Handshake packets we've built, keyed by (protocol, keepalive-interval).
+    # These are identical for all endpoints using the same values.
+    _handshake_cache: dict[tuple[int, float], bytes] = {}
+
     def __init__(self,
                  handle_raw_message_call: Callable[[bytes], Awaitable[bytes]],
                  reader: asyncio.StreamReader,
@@ -132,7 +156,7 @@ class RPCEndpoint:
         self._closing = False
         self._did_wait_closed = False
         self._event_loop = asyncio.get_running_loop()
-        self._out_packets: list[bytes] = []
+        self._out_chunks: list[bytes] = []
         self._have_out_packets = asyncio.Event()
         self._run_called = False
         self._peer_info: _PeerInfo | None = None
@@ -140,14 +164,14 @@ class RPCEndpoint:
         self._keepalive_timeout = keepalive_timeout
 
         # Need to hold weak-refs to these otherwise it creates dep-loops
-        # which keeps us alive.
-        self._tasks: list[weakref.ref[asyncio.Task]] = []
+        # which keeps us alive. Tasks remove themselves when done.
+        self._tasks: weakref.WeakSet[asyncio.Task] = weakref.WeakSet()
 
         # When we last got a keepalive or equivalent (time.monotonic value)
         self._last_keepalive_receive_time: float | None = None
 
         # (Start near the end to make sure our looping logic is sound).
-        self._next_message_id = 65530
+        self._message_ids = itertools.count(65530)
 
         self._in_flight_messages: dict[int, _InFlightMessage] = {}
 
@@ -175,7 +199,8 @@ class RPCEndpoint:
             asyncio.create_task(
                 self._run_core_task('write', self._run_write_task()))
         ]
-        self._tasks += [weakref.ref(t) for t in core_tasks]
+        for task in core_tasks:
+            self._track_task(task)
 
         # Run our core tasks until they all complete.
         results = await asyncio.gather(*core_tasks, return_exceptions=True)
@@ -224,61 +249,74 @@ class RPCEndpoint:
             if len(message) > 65535:
                 raise RuntimeError('Message cannot be larger than 65535 bytes')
 
-        # message_id is a 16 bit looping value.
-        message_id = self._next_message_id
-        self._next_message_id = (self._next_message_id + 1) % 65536
+        message_id = self._alloc_message_id()
 
+        # Payload consists of type (1b), message_id (2b),
+        # len (2b or 4b), and data. We pass header and data along
+        # separately so we don't have to copy the data to join them.
         if len(message) > 65535:
-            # Payload consists of type (1b), message_id (2b),
-            # len (4b), and data.
-            self._enqueue_outgoing_packet(
-                _PacketType.MESSAGE_BIG.value.to_bytes(1, _BYTE_ORDER) +
-                message_id.to_bytes(2, _BYTE_ORDER) +
-                len(message).to_bytes(4, _BYTE_ORDER) + message)
+            header = _HEADER_BIG.pack(_PacketType.MESSAGE_BIG.value,
+                                      message_id, len(message))
         else:
-            # Payload consists of type (1b), message_id (2b),
-            # len (2b), and data.
-            self._enqueue_outgoing_packet(
-                _PacketType.MESSAGE.value.to_bytes(1, _BYTE_ORDER) +
-                message_id.to_bytes(2, _BYTE_ORDER) +
-                len(message).to_bytes(2, _BYTE_ORDER) + message)
+            header = _HEADER.pack(_PacketType.MESSAGE.value, message_id,
+                                  len(message))
+        self._enqueue_outgoing_packet(header, message)
 
         # Make an entry so we know this message is out there.
-        assert message_id not in self._in_flight_messages
         msgobj = self._in_flight_messages[message_id] = _InFlightMessage()
 
-        # Also add its task to our list so we properly cancel it if we die.
-        self._prune_tasks()  # Keep our list from filling with dead tasks.
-        self._tasks.append(weakref.ref(msgobj.wait_task))
-
         # Note: we always want to incorporate a timeout. Individual
         # messages may hang or error on the other end and this ensures
-        # we won't build up lots of zombie tasks waiting around for
+        # we won't build up lots of zombie messages waiting around for
         # responses that will never arrive.
         if timeout is None:
             timeout = self.DEFAULT_MESSAGE_TIMEOUT
         assert timeout is not None
         try:
-            return await asyncio.wait_for(msgobj.wait_task, timeout=timeout)
+            return await self._wait_for_response(msgobj, timeout)
         except asyncio.CancelledError as exc:
             if self._debug_print:
                 self._debug_print_call(
                     f'{self._label}: message {message_id} was cancelled.')
+            self._in_flight_messages.pop(message_id, None)
             raise CommunicationError() from exc
         except asyncio.TimeoutError as exc:
             if self._debug_print:
                 self._debug_print_call(
                     f'{self._label}: message {message_id} timed out.')
 
-            # Stop waiting on the response.
-            msgobj.wait_task.cancel()
-
-            # Remove the record of this message.
-            del self._in_flight_messages[message_id]
+            # Remove the record of this message (its future has already
+            # been cancelled for us).
+            self._in_flight_messages.pop(message_id, None)
 
             # Let the user know something went wrong.
             raise CommunicationError() from exc
 
+    def _alloc_message_id(self) -> int:
+        """Return an id for a new outgoing message."""
+        if len(self._in_flight_messages) >= self.MAX_IN_FLIGHT_MESSAGES:
+            raise CommunicationError('Too many in-flight messages')
+
+        # message_id is a 16 bit looping value. If we've wrapped around
+        # to one that's still awaiting a response (a long-running
+        # message, etc.), just skip past it.
+        message_id = next(self._message_ids) & 0xFFFF
+        while message_id in self._in_flight_messages:
+            message_id = next(self._message_ids) & 0xFFFF
+        return message_id
+
+    async def _wait_for_response(self, msgobj: _InFlightMessage,
+                                 timeout: float) -> bytes:
+        """Wait for a message's response, raising on timeout."""
+        # asyncio.timeout() just arms a cancel on the current task
+        # instead of wrapping things in a new one like wait_for().
+        if sys.version_info >= (3, 11):
+            async with asyncio.timeout(timeout):
+                response = await msgobj.future
+        else:
+            response = await asyncio.wait_for(msgobj.future, timeout=timeout)
+        return response
+
     def close(self) -> None:
         """I said seagulls; mmmm; stop it now."""
         self._check_env()
@@ -297,6 +335,13 @@ class RPCEndpoint:
         for task in self._get_live_tasks():
             task.cancel()
 
+        # Also fail any messages still waiting on responses.
+        for msgobj in self._in_flight_messages.values():
+            if not msgobj.future.done():
+                msgobj.future.set_exception(
+                    CommunicationError('Endpoint closed'))
+        self._in_flight_messages.clear()
+
         if self._debug_print:
             self._debug_print_call(f'{self._label}: closing writer...')
         self._writer.close()
@@ -385,49 +430,69 @@ class RPCEndpoint:
         # we'll know if/how we can talk to them.
         mlen = await self._read_int_32()
         message = (await self._reader.readexactly(mlen))
+        # (This happens once per connection and _PeerInfo's io schema is
+        # already prepped at import time via @ioprepped, so there's not
+        # much to be gained by hand-rolling this).
         self._peer_info = dataclass_from_json(_PeerInfo, message.decode())
         self._last_keepalive_receive_time = time.monotonic()
         if self._debug_print:
             self._debug_print_call(
                 f'{self._label}: received handshake at {self._tm()}.')
 
+        # This loop runs for every packet we receive, so pull the stuff
+        # it uses into locals to skip repeated global/attr lookups.
+        # We also dispatch on raw type values here instead of building
+        # a _PacketType for each packet.
+        readexactly = self._reader.readexactly
+        handle_message_packet = self._handle_message_packet
+        handle_response_packet = self._handle_response_packet
+        monotonic = time.monotonic
+        pt_handshake = _PacketType.HANDSHAKE.value
+        pt_keepalive = _PacketType.KEEPALIVE.value
+        pt_message = _PacketType.MESSAGE.value
+        pt_message_big = _PacketType.MESSAGE_BIG.value
+        pt_response = _PacketType.RESPONSE.value
+        pt_response_big = _PacketType.RESPONSE_BIG.value
+
         # Now just sit and handle stuff as it comes in.
         while True:
             assert not self._closing
 
             # Read message type.
-            mtype = _PacketType(await self._read_int_8())
-            if mtype is _PacketType.HANDSHAKE:
+            mtype = (await readexactly(1))[0]
+            if mtype == pt_handshake:
                 raise RuntimeError('Got multiple handshakes')
 
-            if mtype is _PacketType.KEEPALIVE:
+            if mtype == pt_keepalive:
                 if self._debug_print_io:
                     self._debug_print_call(f'{self._label}: received keepalive'
                                            f' at {self._tm()}.')
-                self._last_keepalive_receive_time = time.monotonic()
+                self._last_keepalive_receive_time = monotonic()
 
-            elif mtype is _PacketType.MESSAGE:
-                await self._handle_message_packet(big=False)
+            elif mtype == pt_message:
+                await handle_message_packet(big=False)
 
-            elif mtype is _PacketType.MESSAGE_BIG:
-                await self._handle_message_packet(big=True)
+            elif mtype == pt_message_big:
+                await handle_message_packet(big=True)
 
-            elif mtype is _PacketType.RESPONSE:
-                await self._handle_response_packet(big=False)
+            elif mtype == pt_response:
+                await handle_response_packet(big=False)
 
-            elif mtype is _PacketType.RESPONSE_BIG:
-                await self._handle_response_packet(big=True)
+            elif mtype == pt_response_big:
+                await handle_response_packet(big=True)
 
             else:
-                assert_never(mtype)
+                raise RuntimeError(f'Unhandled packet type: {mtype}')
 
     async def _handle_message_packet(self, big: bool) -> None:
         assert self._peer_info is not None
-        msgid = await self._read_int_16()
-        if big:
-            msglen = await self._read_int_32()
-        else:
-            msglen = await self._read_int_16()
+        msgid, msglen = await self._read_subheader(big)
+
+        # Note: readexactly() copies out of the StreamReader's internal
+        # buffer. We could avoid that with our own BufferedProtocol, but
+        # that would mean taking a protocol instead of a reader/writer
+        # pair and passing memoryviews instead of bytes to handlers, so
+        # we're sticking with streams for now.
         msg = await self._reader.readexactly(msglen)
         if self._debug_print_io:
             self._debug_print_call(f'{self._label}: received message {msgid}'
@@ -436,27 +501,22 @@ class RPCEndpoint:
         # Create a message-task to handle this message and return
         # a response (we don't want to block while that happens).
         assert not self._closing
-        self._prune_tasks()  # Keep from filling with dead tasks.
-        self._tasks.append(
-            weakref.ref(
-                asyncio.create_task(
-                    self._handle_raw_message(message_id=msgid, message=msg))))
-        self._debug_print_call(
-            f'{self._label}: done handling message at {self._tm()}.')
+        self._track_task(
+            asyncio.create_task(
+                self._handle_raw_message(message_id=msgid, message=msg)))
+        if self._debug_print_io:
+            self._debug_print_call(
+                f'{self._label}: done handling message at {self._tm()}.')
 
     async def _handle_response_packet(self, big: bool) -> None:
         assert self._peer_info is not None
-        msgid = await self._read_int_16()
         # Protocol 2 gained 32 bit data lengths.
-        if big:
-            rsplen = await self._read_int_32()
-        else:
-            rsplen = await self._read_int_16()
+        msgid, rsplen = await self._read_subheader(big)
         if self._debug_print_io:
             self._debug_print_call(f'{self._label}: received response {msgid}'
                                    f' of size {rsplen} at {self._tm()}.')
         rsp = await self._reader.readexactly(rsplen)
-        msgobj = self._in_flight_messages.get(msgid)
+        msgobj = self._in_flight_messages.pop(msgid, None)
         if msgobj is None:
             # It's possible for us to get a response to a message
             # that has timed out. In this case we will have no local
@@ -474,10 +534,7 @@ class RPCEndpoint:
         self._check_env()
 
         # Introduce ourself so our peer knows how it can talk to us.
-        data = dataclass_to_json(
-            _PeerInfo(protocol=OUR_PROTOCOL,
-                      keepalive_interval=self._keepalive_interval)).encode()
-        self._writer.write(len(data).to_bytes(4, _BYTE_ORDER) + data)
+        self._writer.write(self._get_handshake())
 
         # Now just write out-messages as they come in.
         while True:
@@ -485,15 +542,32 @@ class RPCEndpoint:
             # Wait until some data comes in.
             await self._have_out_packets.wait()
 
-            assert self._out_packets
-            data = self._out_packets.pop(0)
-
-            # Important: only clear this once all packets are sent.
-            if not self._out_packets:
-                self._have_out_packets.clear()
-
-            self._writer.write(data)
-            # await self._writer.drain()
+            # Grab everything that's queued and send it out in one go.
+            assert self._out_chunks
+            chunks = self._out_chunks
+            self._out_chunks = []
+            self._have_out_packets.clear()
+            self._writer.writelines(chunks)
+
+            # Only wait on the transport once it starts backing up;
+            # otherwise we keep piling data into memory.
+            transport = self._writer.transport
+            if (transport.get_write_buffer_size() >
+                    transport.get_write_buffer_limits()[1]):
+                await self._writer.drain()
+
+    def _get_handshake(self) -> bytes:
+        """Return our full handshake packet (shared between endpoints)."""
+        key = (OUR_PROTOCOL, self._keepalive_interval)
+        handshake = self._handshake_cache.get(key)
+        if handshake is None:
+            data = dataclass_to_json(
+                _PeerInfo(
+                    protocol=OUR_PROTOCOL,
+                    keepalive_interval=self._keepalive_interval)).encode()
+            handshake = _HANDSHAKE_LEN.pack(len(data)) + data
+            self._handshake_cache[key] = handshake
+        return handshake
 
     async def _run_keepalive_task(self) -> None:
         """Send periodic keepalive packets."""
@@ -506,12 +580,18 @@ class RPCEndpoint:
         # connection is lagging). It sounds like we could have the TCP
         # layer do this sort of thing itself but that might be
         # OS-specific so gonna go this way for now.
-        while True:
-            assert not self._closing
-            await asyncio.sleep(self._keepalive_interval)
+        # Rather than sleeping in a loop we drive this from timer
+        # callbacks (one less future per tick, and scheduling against
+        # absolute times keeps us from drifting). We just sit here until
+        # one of them tells us the connection has timed out.
+        loop = self._event_loop
+        timed_out = asyncio.Event()
+        next_time = loop.time()
+        handle: asyncio.TimerHandle | None = None
+
+        def _tick() -> None:
             if not self.test_suppress_keepalives:
-                self._enqueue_outgoing_packet(
-                    _PacketType.KEEPALIVE.value.to_bytes(1, _BYTE_ORDER))
+                self._enqueue_outgoing_packet(_KEEPALIVE_PACKET)
 
             # Also go ahead and handle dropping the connection if we
             # haven't heard from the peer in a while.
@@ -526,7 +606,25 @@ class RPCEndpoint:
                     self._debug_print_call(
                         f'{self._label}: reached keepalive time-out'
                         f' ({since:.1f}s).')
-                raise _KeepaliveTimeoutError()
+                timed_out.set()
+                return
+            _schedule()
+
+        def _schedule() -> None:
+            nonlocal next_time, handle
+            # (If we've fallen behind, don't fire a burst to catch up).
+            next_time = max(next_time + self._keepalive_interval, loop.time())
+            handle = loop.call_at(next_time, _tick)
+
+        _schedule()
+        try:
+            await timed_out.wait()
+        finally:
+            # Make sure we don't keep ticking (and keeping ourself alive)
+            # once we're cancelled.
+            if handle is not None:
+                handle.cancel()
+        raise _KeepaliveTimeoutError()
 
     async def _run_core_task(self, tasklabel: str, call: Awaitable) -> None:
         try:
@@ -569,27 +667,26 @@ class RPCEndpoint:
                     'Response cannot be larger than 65535 bytes')
 
         # Now send back our response.
-        # Payload consists of type (1b), msgid (2b), len (2b), and data.
+        # Payload consists of type (1b), msgid (2b), len (2b or 4b),
+        # and data.
         if len(response) > 65535:
-            self._enqueue_outgoing_packet(
-                _PacketType.RESPONSE_BIG.value.to_bytes(1, _BYTE_ORDER) +
-                message_id.to_bytes(2, _BYTE_ORDER) +
-                len(response).to_bytes(4, _BYTE_ORDER) + response)
+            header = _HEADER_BIG.pack(_PacketType.RESPONSE_BIG.value,
+                                      message_id, len(response))
         else:
-            self._enqueue_outgoing_packet(
-                _PacketType.RESPONSE.value.to_bytes(1, _BYTE_ORDER) +
-                message_id.to_bytes(2, _BYTE_ORDER) +
-                len(response).to_bytes(2, _BYTE_ORDER) + response)
-
-    async def _read_int_8(self) -> int:
-        return int.from_bytes(await self._reader.readexactly(1), _BYTE_ORDER)
-
-    async def _read_int_16(self) -> int:
-        return int.from_bytes(await self._reader.readexactly(2), _BYTE_ORDER)
+            header = _HEADER.pack(_PacketType.RESPONSE.value, message_id,
+                                  len(response))
+        self._enqueue_outgoing_packet(header, response)
 
     async def _read_int_32(self) -> int:
         return int.from_bytes(await self._reader.readexactly(4), _BYTE_ORDER)
 
+    async def _read_subheader(self, big: bool) -> tuple[int, int]:
+        """Read a message_id and len in one go."""
+        hstruct = _SUBHEADER_BIG if big else _SUBHEADER
+        data = await self._reader.readexactly(hstruct.size)
+        msgid, msglen = hstruct.unpack(data)
+        return msgid, msglen
+
     @classmethod
     def _is_expected_connection_error(cls, exc: Exception) -> bool:
         """Stuff we expect to end our connection in normal circumstances."""
@@ -603,37 +700,55 @@ class RPCEndpoint:
         # I was seeing that asyncio stuff wasn't working as expected if
         # created in one thread and used in another, so let's enforce
         # a single thread for all use of an instance.
-        if current_thread() is not self._thread:
-            raise RuntimeError('This must be called from the same thread'
-                               ' that the endpoint was created in.')
+        # (This gets called a lot, so we skip it in optimized builds).
+        if __debug__:
+            if current_thread() is not self._thread:
+                raise RuntimeError('This must be called from the same thread'
+                                   ' that the endpoint was created in.')
 
-        # This should always be the case if thread is the same.
-        assert asyncio.get_running_loop() is self._event_loop
+            # This should always be the case if thread is the same.
+            assert asyncio.get_running_loop() is self._event_loop
 
-    def _enqueue_outgoing_packet(self, data: bytes) -> None:
-        """Enqueue a raw packet to be sent. Must be called from our loop."""
+    def _enqueue_outgoing_packet(self, *chunks: bytes) -> None:
+        """Enqueue a raw packet to be sent. Must be called from our loop.
+
+        The packet can be passed as multiple chunks (header, data, etc.)
+        which are written out as-is without being joined.
+        """
         self._check_env()
 
         if self._debug_print_io:
+            dataval = b''.join(chunks)
             self._debug_print_call(f'{self._label}: enqueueing outgoing packet'
-                                   f' {data[:50]!r} at {self._tm()}.')
+                                   f' {dataval[:50]!r} at {self._tm()}.')
 
         # Add the data and let our write task know about it.
-        self._out_packets.append(data)
+        self._out_chunks.extend(chunks)
         self._have_out_packets.set()
 
-    def _prune_tasks(self) -> None:
-        out: list[weakref.ref[asyncio.Task]] = []
-        for task_weak_ref in self._tasks:
-            task = task_weak_ref()
-            if task is not None and not task.done():
-                out.append(task_weak_ref)
-        self._tasks = out
+    def _track_task(self, task: asyncio.Task) -> None:
+        """Keep track of a task so we can cancel it if we die."""
+        # Note: asyncio.TaskGroup would handle this for us but requires
+        # Python 3.11, and it also cancels all of its tasks if any one
+        # fails, which we don't want for independent message handlers.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
     def _get_live_tasks(self) -> list[asyncio.Task]:
-        out: list[asyncio.Task] = []
-        for task_weak_ref in self._tasks:
-            task = task_weak_ref()
-            if task is not None and not task.done():
-                out.append(task)
-        return out
+        return [t for t in self._tasks if not t.done()]
+
+
+def install_uvloop() -> bool:
+    """Use uvloop for asyncio event loops if it is available.
+
+    uvloop does its socket reads/writes in C and can be a good deal faster
+    than the default loop for endpoints pushing lots of small messages.
+    This must be called before the loop is created (before asyncio.run(),
+    etc.). Returns whether uvloop is now in use.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True